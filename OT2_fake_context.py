@@ -0,0 +1,455 @@
+import importlib.util
+import sys
+import types
+
+'''
+Offline stand-in for the Opentrons ProtocolContext.
+Main Points:
+-Runs a protocol's run() without the opentrons package or a robot
+-Records every command and tracks the liquid volume in each well and tip
+-Raises on the mistakes the simulator would catch: double pickups, used tips,
+ tip overfill, wells off the edge of a plate for the nozzle layout
+-Only the labware and module calls used by the protocols in this repo are modelled
+'''
+
+# (rows, columns, well shape) per load name. Shapes are (diameter, length, width,
+# depth, max volume) in mm and µL, close to the Opentrons definitions.
+LABWARE = {
+    "nest_96_wellplate_200ul_flat": (8, 12, (6.85, None, None, 10.9, 360)),
+    "nest_96_wellplate_100ul_pcr_full_skirt": (8, 12, (5.34, None, None, 14.78, 100)),
+    "opentrons_96_wellplate_200ul_pcr_full_skirt": (8, 12, (5.46, None, None, 14.95, 200)),
+    "opentrons_96_aluminumblock_generic_pcr_strip_200ul": (8, 12, (5.46, None, None, 20.0, 200)),
+    "appliedbiosystemsmicroamp_384_wellplate_40ul": (16, 24, (3.17, None, None, 9.09, 40)),
+    "axygen_96_wellplate_500ul": (8, 12, (6.73, None, None, 19.3, 500)),
+    "opentrons_tough_4_reservoir_72ml": (1, 4, (None, 26.0, 107.0, 38.0, 72000)),
+    "opentrons_24_tuberack_eppendorf_1.5ml_safelock_snapcap": (4, 6, (8.69, None, None, 37.05, 1500)),
+    "opentrons_96_tiprack_20ul": (8, 12, (3.27, None, None, 39.2, 20)),
+    "opentrons_96_tiprack_300ul": (8, 12, (5.23, None, None, 59.3, 300)),
+}
+
+# Methods the protocols in this repo call, per module load name. Anything else raises,
+# so a typo or an unmodelled call fails offline instead of on the robot.
+MODULES = {
+    "temperature module gen2": ("start_set_temperature", "set_temperature", "deactivate"),
+    "heaterShakerModuleV1": ("close_labware_latch", "set_target_temperature", "wait_for_temperature",
+                             "set_and_wait_for_temperature", "set_and_wait_for_shake_speed",
+                             "deactivate_heater", "deactivate_shaker"),
+    "thermocycler": ("open_lid", "close_lid", "set_lid_temperature", "deactivate_lid",
+                     "set_block_temperature"),
+}
+
+PIPETTES = {
+    "p20_single_gen2": (1, 20, 7.56),
+    "p20_multi_gen2": (8, 20, 7.6),
+    "p300_single_gen2": (1, 300, 92.86),
+    "p300_multi_gen2": (8, 300, 94),
+}
+
+class FakeError(RuntimeError):
+    '''A command the robot would refuse.'''
+
+def install_protocol_api():
+    '''Make ``from opentrons import protocol_api`` work when opentrons is not installed.'''
+    try:
+        import opentrons.protocol_api  # noqa: F401
+        return
+    except ImportError:
+        pass
+    protocol_api = types.ModuleType("opentrons.protocol_api")
+    protocol_api.ProtocolContext = FakeProtocolContext
+    for style in ("ALL", "SINGLE", "ROW", "COLUMN", "PARTIAL_COLUMN"):
+        setattr(protocol_api, style, style)
+    opentrons = types.ModuleType("opentrons")
+    opentrons.protocol_api = protocol_api
+    sys.modules["opentrons"] = opentrons
+    sys.modules["opentrons.protocol_api"] = protocol_api
+
+def load_protocol(path):
+    '''Import a protocol file as a module.'''
+    install_protocol_api()
+    name = path.rsplit("/", 1)[-1].removesuffix(".py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_protocol(module, loaded=None, on_pause=None, **params):
+    '''
+    Run a protocol module against a fresh fake context.
+
+    :param loaded: Liquid placed before the run, as {slot: {well name: µL}}.
+    :param on_pause: Called as on_pause(protocol, msg) at each pause, to act for the operator.
+    :param params: Runtime parameter overrides by variable name. CSV parameters
+                   take the file contents as a string.
+    :return: The FakeProtocolContext after the run.
+    '''
+    parameters = FakeParameters()
+    if hasattr(module, "add_parameters"):
+        module.add_parameters(parameters)
+    protocol = FakeProtocolContext(parameters.values(params), loaded, on_pause)
+    module.run(protocol)
+    return protocol
+
+#---------
+# Runtime parameters
+#---------
+
+class FakeCSV:
+    def __init__(self, contents):
+        self.contents = contents
+
+    def parse_as_csv(self, detect_dialect=True):
+        import csv
+        return [row for row in csv.reader(self.contents.splitlines())]
+
+class FakeParameters:
+    def __init__(self):
+        self._defaults = {}
+        self._csv = set()
+
+    def _add(self, variable_name, default=None, **kwargs):
+        self._defaults[variable_name] = default
+
+    add_int = add_float = add_bool = add_str = _add
+
+    def add_csv_file(self, variable_name, **kwargs):
+        self._defaults[variable_name] = None
+        self._csv.add(variable_name)
+
+    def values(self, overrides):
+        unknown = set(overrides) - set(self._defaults)
+        if unknown:
+            raise FakeError(f"Unknown runtime parameters: {sorted(unknown)}")
+        values = dict(self._defaults, **overrides)
+        for name in self._csv:
+            if values[name] is not None:
+                values[name] = FakeCSV(values[name])
+        return types.SimpleNamespace(**values)
+
+#---------
+# Labware
+#---------
+
+class FakeLocation:
+    def __init__(self, well, z):
+        self.well = well
+        self.z = z
+
+class FakeWell:
+    def __init__(self, labware, name, shape):
+        self.parent = labware
+        self.well_name = name
+        self.diameter, self.length, self.width, self.depth, self.max_volume = shape
+        self.volume = 0.0
+        self.lowest = 0.0  # below zero when more was drawn than was there
+        self.tip = "fresh"
+
+    @property
+    def display_name(self):
+        return f"{self.well_name} of {self.parent.load_name}"
+
+    def top(self, z=0):
+        return FakeLocation(self, self.depth + z)
+
+    def bottom(self, z=0):
+        return FakeLocation(self, z)
+
+    def __repr__(self):
+        return self.display_name
+
+class FakeLabware:
+    def __init__(self, load_name, location):
+        if load_name not in LABWARE:
+            raise FakeError(f"No fake definition for labware '{load_name}'.")
+        self.load_name = load_name
+        self.location = location
+        n_rows, n_cols, shape = LABWARE[load_name]
+        self._rows = [[FakeWell(self, f"{chr(ord('A') + r)}{c + 1}", shape) for c in range(n_cols)]
+                      for r in range(n_rows)]
+
+    def rows(self):
+        return [list(row) for row in self._rows]
+
+    def columns(self):
+        return [list(col) for col in zip(*self._rows)]
+
+    def wells(self):
+        return [well for col in self.columns() for well in col]
+
+    def wells_by_name(self):
+        return {well.well_name: well for well in self.wells()}
+
+    def __getitem__(self, name):
+        return self.wells_by_name()[name]
+
+    def __repr__(self):
+        return f"{self.load_name} in {self.location}"
+
+class FakeAdapter:
+    def __init__(self, protocol, load_name, location):
+        self._protocol = protocol
+        self.load_name = load_name
+        self.location = location
+
+    def load_labware(self, name, label=None):
+        return self._protocol.load_labware(name, self.location)
+
+#---------
+# Modules
+#---------
+
+class FakeModule:
+    '''Any module in MODULES: load calls are modelled, its listed methods are recorded.'''
+
+    def __init__(self, protocol, name, location):
+        if name not in MODULES:
+            raise FakeError(f"No fake definition for module '{name}'.")
+        self._protocol = protocol
+        self.name = name
+        self.location = location
+        self.target = None
+        self.temperature = 25.0
+
+    def load_adapter(self, name):
+        return FakeAdapter(self._protocol, name, self.location)
+
+    def load_labware(self, name, label=None):
+        return self._protocol.load_labware(name, self.location)
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        if method not in MODULES[self.name]:
+            raise FakeError(f"{self.name}: {method}() is not modelled.")
+
+        def record(*args, **kwargs):
+            celsius = kwargs.get("celsius", kwargs.get("temperature", args[0] if args else None))
+            if method in ("start_set_temperature", "set_temperature", "set_block_temperature"):
+                self.target = self.temperature = celsius
+            self._protocol.record(self.name, method, *args, **kwargs)
+        return record
+
+#---------
+# Pipettes
+#---------
+
+class FakePipette:
+    def __init__(self, protocol, name, mount, tip_racks):
+        if name not in PIPETTES:
+            raise FakeError(f"No fake definition for pipette '{name}'.")
+        self._protocol = protocol
+        self.name = name
+        self.mount = mount
+        self.channels, self.max_volume, default_rate = PIPETTES[name]
+        self.tip_racks = list(tip_racks or [])
+        self.flow_rate = types.SimpleNamespace(aspirate=default_rate, dispense=default_rate, blow_out=default_rate)
+        self.well_bottom_clearance = types.SimpleNamespace(aspirate=1.0, dispense=1.0)
+        self.rows = self.channels
+        self.primary = "A1"
+        self.tips = None
+        self.tip_volume = 0.0
+        self.pickups = 0
+        self._location = None
+
+    @property
+    def has_tip(self):
+        return self.tips is not None
+
+    @property
+    def current_volume(self):
+        return self.tip_volume
+
+    def _record(self, method, *args, **kwargs):
+        self._protocol.record(self.name, method, *args, **kwargs)
+
+    def _footprint(self, location):
+        '''Wells under the active nozzles when the primary nozzle is at ``location``.'''
+        well = location.well if isinstance(location, FakeLocation) else location
+        if well is None:
+            raise FakeError(f"{self.name}: no location given and no previous location.")
+        if self.rows == 1:
+            return [well]
+        labware = well.parent
+        step = len(labware.rows()) // 8
+        if step == 0:
+            return [well] * self.rows
+        row = ord(well.well_name[0]) - ord("A")
+        first = row if self.primary == "A1" else row - step * (self.rows - 1)
+        wells = []
+        for n in range(self.rows):
+            r = first + n * step
+            if not 0 <= r < len(labware.rows()):
+                raise FakeError(f"{self.name}: {self.rows} channels at {well} run off {labware.load_name}.")
+            wells.append(labware.wells_by_name()[f"{chr(ord('A') + r)}{well.well_name[1:]}"])
+        return wells
+
+    def _move(self, location):
+        if location is None:
+            location = self._location
+        self._location = location
+        return location
+
+    def configure_nozzle_layout(self, style, start=None, end=None, tip_racks=None):
+        if self.has_tip:
+            raise FakeError(f"{self.name}: cannot change the nozzle layout with a tip attached.")
+        style = getattr(style, "name", style)
+        if style == "ALL":
+            self.rows, self.primary = self.channels, "A1"
+        elif style == "SINGLE":
+            self.rows, self.primary = 1, start
+        elif style == "PARTIAL_COLUMN":
+            self.rows, self.primary = ord(start[0]) - ord(end[0]) + 1, start
+            if start != "H1" or not 2 <= self.rows <= 7:
+                raise FakeError(f"{self.name}: OT-2 partial columns run from H1 over 2-7 nozzles.")
+        else:
+            raise FakeError(f"{self.name}: nozzle layout {style} is not modelled.")
+        self._record("configure_nozzle_layout", style)
+
+    def pick_up_tip(self, location=None):
+        if self.has_tip:
+            raise FakeError(f"{self.name}: already holding a tip.")
+        if location is None:
+            location = self._next_tip()
+        tips = self._footprint(location)
+        for tip in tips:
+            if tip.tip not in ("fresh", "returned"):
+                raise FakeError(f"{self.name}: tip {tip} is {tip.tip}.")
+            tip.tip = "attached"
+        self.tips = tips
+        self.pickups += 1
+        self._record("pick_up_tip", location)
+
+    def _next_tip(self):
+        if self.rows != self.channels:
+            raise FakeError(f"{self.name}: automatic pickup needs a full nozzle layout.")
+        for rack in self.tip_racks:
+            for col in rack.columns():
+                if self.channels == 1:
+                    fresh = [tip for tip in col if tip.tip == "fresh"]
+                    if fresh:
+                        return fresh[0]
+                elif all(tip.tip == "fresh" for tip in col):
+                    return col[0]
+        raise FakeError(f"{self.name}: out of tips.")
+
+    def _release(self, state, method):
+        if not self.has_tip:
+            raise FakeError(f"{self.name}: no tip to {method}.")
+        if self.tip_volume > 1e-6:
+            raise FakeError(f"{self.name}: {method} with {self.tip_volume:.2f} µL still in the tip.")
+        for tip in self.tips:
+            tip.tip = state
+        self.tips = None
+        self._record(method)
+
+    def return_tip(self):
+        self._release("returned", "return_tip")
+
+    def drop_tip(self):
+        self._release("dropped", "drop_tip")
+
+    def aspirate(self, volume=None, location=None, rate=1.0):
+        if not self.has_tip:
+            raise FakeError(f"{self.name}: aspirate without a tip.")
+        location = self._move(location)
+        volume = self.max_volume - self.tip_volume if volume is None else volume
+        if self.tip_volume + volume > self.max_volume + 1e-6:
+            raise FakeError(f"{self.name}: {self.tip_volume + volume} µL exceeds the {self.max_volume} µL tip.")
+        for well in self._footprint(location):
+            well.volume -= volume
+            well.lowest = min(well.lowest, well.volume)
+        self.tip_volume += volume
+        self._record("aspirate", volume, location, rate=rate)
+
+    def dispense(self, volume=None, location=None, rate=1.0, push_out=None):
+        location = self._move(location)
+        volume = self.tip_volume if volume is None else volume
+        if volume > self.tip_volume + 1e-6:
+            raise FakeError(f"{self.name}: dispense {volume} µL with {self.tip_volume} µL in the tip.")
+        for well in self._footprint(location):
+            well.volume += volume
+            if well.volume > well.max_volume + 1e-6:
+                raise FakeError(f"{self.name}: {well.volume:.1f} µL in {well.display_name} exceeds "
+                                f"the {well.max_volume} µL well.")
+        self.tip_volume -= volume
+        self._record("dispense", volume, location, rate=rate)
+
+    def mix(self, repetitions=1, volume=None, location=None, rate=1.0):
+        location = self._move(location)
+        volume = self.max_volume if volume is None else volume
+        if not self.has_tip or volume > self.max_volume:
+            raise FakeError(f"{self.name}: cannot mix {volume} µL.")
+        self._record("mix", repetitions, volume, location, rate=rate)
+
+    def blow_out(self, location=None):
+        location = self._move(location)
+        if self.tip_volume:
+            self.dispense(self.tip_volume, location)
+        self._record("blow_out", location)
+
+    def touch_tip(self, location=None, radius=1.0, v_offset=-1.0, speed=60.0):
+        self._record("touch_tip", self._move(location))
+
+#---------
+# Protocol context
+#---------
+
+class FakeProtocolContext:
+    def __init__(self, params=None, loaded=None, on_pause=None):
+        self.params = params or types.SimpleNamespace()
+        self.loaded = loaded or {}
+        self.on_pause = on_pause
+        self.commands = []
+        self.labware = []
+        self.pipettes = []
+        self.delay_seconds = 0.0
+
+    def record(self, target, method, *args, **kwargs):
+        self.commands.append((target, method, args, kwargs))
+
+    def is_simulating(self):
+        return True
+
+    def load_labware(self, load_name, location, label=None):
+        labware = FakeLabware(load_name, location)
+        for name, volume in self.loaded.get(location, {}).items():
+            labware[name].volume = labware[name].lowest = volume
+        self.labware.append(labware)
+        return labware
+
+    def load_module(self, module_name, location=None):
+        return FakeModule(self, module_name, location)
+
+    def load_instrument(self, instrument_name, mount, tip_racks=None):
+        pipette = FakePipette(self, instrument_name, mount, tip_racks)
+        self.pipettes.append(pipette)
+        return pipette
+
+    def delay(self, seconds=0, minutes=0, msg=None):
+        self.delay_seconds += seconds + 60 * minutes
+        self.record("protocol", "delay", seconds=seconds, minutes=minutes)
+
+    def comment(self, msg):
+        self.record("protocol", "comment", msg)
+
+    def pause(self, msg=None):
+        self.record("protocol", "pause", msg)
+        if self.on_pause:
+            self.on_pause(self, msg)
+
+    def set_rail_lights(self, on):
+        self.record("protocol", "set_rail_lights", on)
+
+    #---------
+    # Run inspection
+    #---------
+
+    def first(self, target, method, where=lambda args, kwargs: True):
+        '''Index of the first matching command, or None.'''
+        for n, (t, m, args, kwargs) in enumerate(self.commands):
+            if t == target and m == method and where(args, kwargs):
+                return n
+        return None
+
+    def comments(self):
+        return [args[0] for t, m, args, kwargs in self.commands if m == "comment"]
@@ -0,0 +1,435 @@
+import csv
+import hashlib
+import inspect
+import json
+import math
+import os
+import re
+import time
+from OT2_fake_context import load_protocol, run_protocol, FakeLocation, FakeProtocolContext
+import PCR_OT2_CSV_to_dict
+
+'''
+Offline checks for every protocol in this repo, run against OT2_fake_context.
+Main Points:
+-Runs each protocol at several sample counts in well under a second
+-Checks tip counts, the final volume in every well and the order of the protocol steps
+-Run with: python OT2_protocol_checks.py
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def protocol_module(file_name):
+    return load_protocol(os.path.join(HERE, file_name))
+
+def labware_in(protocol, slot):
+    return next(labware for labware in protocol.labware if labware.location == slot)
+
+def pipette(protocol, name):
+    return next(p for p in protocol.pipettes if p.name == name)
+
+def into(labware):
+    '''Command filter for aspirates and dispenses at ``labware``.'''
+    def where(args, kwargs):
+        location = args[1]
+        well = location.well if isinstance(location, FakeLocation) else location
+        return well.parent is labware
+    return where
+
+def check_order(protocol, steps):
+    '''Each (name, command index) must come after the one before it.'''
+    for (before, a), (after, b) in zip(steps, steps[1:]):
+        assert a is not None and b is not None, f"missing step: {before if a is None else after}"
+        assert a < b, f"{before} should come before {after}"
+
+def plate_wells(count, rows=8):
+    '''Names of the first ``count`` wells of a plate, in column order.'''
+    return [f"{chr(ord('A') + n % rows)}{n // rows + 1}" for n in range(count)]
+
+def check_volumes(protocol, expected):
+    '''
+    Every well ends at its volume in ``expected`` ({slot: {well name: µL}}, 0 when not
+    listed) and no well was ever drawn below empty. Pipettes end empty with no tip.
+    '''
+    for labware in protocol.labware:
+        volumes = expected.get(labware.location, {})
+        for well in labware.wells():
+            want = volumes.get(well.well_name, 0)
+            assert abs(well.volume - want) < 1e-6, f"{well}: {well.volume:.2f} µL, expected {want:.2f} µL"
+            assert well.lowest > -1e-6, f"{well}: drawn {-well.lowest:.2f} µL below empty"
+    for p in protocol.pipettes:
+        assert not p.has_tip and p.tip_volume < 1e-6, f"{p.name} still holds a tip"
+
+#---------
+# Transformation
+#---------
+
+# Liquid placed by hand before a transformation run, in µL.
+COMPETENT_CELLS = 25
+ASSEMBLY = 10
+MEDIA = 40000
+AGAR = 20000
+DILUTION_MEDIA = 36
+
+def transformation_loaded(samples):
+    '''Cells on the temperature module, assemblies in slot 5, media and agar in the reservoir.'''
+    wells = plate_wells(samples)
+    return {"1": {well: COMPETENT_CELLS for well in wells},
+            "5": {well: ASSEMBLY for well in wells},
+            "2": {"A1": MEDIA, "A2": AGAR}}
+
+def transformation_volumes(samples):
+    '''
+    Final volumes once ``samples`` transformations are recovered, diluted and plated.
+
+    Media and agar go to whole columns. Each sample moves 9 µL of assembly onto the
+    cells, 20 µL into 90 µL of recovery media and 3 µL down four 36 µL dilutions,
+    three of which are plated.
+    '''
+    columns = plate_wells(8 * math.ceil(samples / 8))
+    loaded = transformation_loaded(samples)
+    expected = {"1": {well: volume + 9 - 20 for well, volume in loaded["1"].items()},
+                "5": {well: volume - 9 for well, volume in loaded["5"].items()},
+                "2": {"A1": MEDIA - len(columns) * (4 * DILUTION_MEDIA + 90), "A2": AGAR - len(columns) * 3 * 30}}
+    expected["10"] = {well: 90 + 20 - 3 if n < samples else 90 for n, well in enumerate(columns)}
+    for slot in ("3", "6", "9"):
+        expected[slot] = {well: 30 + 3 if n < samples else 30 for n, well in enumerate(columns)}
+    # Dilutions are 384-well quads, [1|3] over [2|4], with the plate taking 3 µL from 2, 3 and 4.
+    expected["8"] = {}
+    for n, well in enumerate(columns):
+        row, col = 2 * (ord(well[0]) - ord("A")), 2 * int(well[1:]) - 1
+        quad = (f"{chr(ord('A') + row)}{col}", f"{chr(ord('A') + row)}{col + 1}",
+                f"{chr(ord('B') + row)}{col}", f"{chr(ord('B') + row)}{col + 1}")
+        for dilution, volume in zip(quad, (DILUTION_MEDIA, DILUTION_MEDIA - 3, DILUTION_MEDIA - 3, DILUTION_MEDIA)
+                                   if n < samples else (DILUTION_MEDIA,) * 4):
+            expected["8"][dilution] = volume
+    return expected
+
+def check_transformation(samples):
+    protocol = run_protocol(protocol_module("Transformation_protocol.py"),
+                            loaded=transformation_loaded(samples), samples=samples)
+    check_volumes(protocol, transformation_volumes(samples))
+    sample_col = math.ceil(samples / 8)
+
+    p20 = pipette(protocol, "p20_multi_gen2")
+    assert p20.pickups == 4 * sample_col, f"{p20.pickups} p20 pickups for {sample_col} columns"
+    tips = [tip for rack in p20.tip_racks for tip in rack.wells() if tip.tip != "fresh"]
+    assert len(tips) == 2 * samples, f"{len(tips)} p20 tips used for {samples} samples"
+    assert pipette(protocol, "p300_multi_gen2").pickups == 2
+    served = [c for c in protocol.comments() if c.startswith("p20 tips")]
+    assert len(served) == 2 * sample_col, f"{len(served)} p20 tip columns reported for {sample_col} columns"
+    assert sum(c.endswith("dilutions -> plating") for c in served) == sample_col, served
+
+    assert any(c.startswith("Heat shock trace") for c in protocol.comments()), "no heat shock trace logged"
+
+    transform = labware_in(protocol, "1")
+    p20_name = p20.name
+    check_order(protocol, [
+        ("transformation", protocol.first(p20_name, "dispense", into(transform))),
+        ("heat shock", protocol.first("temperature module gen2", "start_set_temperature",
+                                      lambda args, kwargs: kwargs.get("celsius") == 40)),
+        ("recovery", protocol.first(p20_name, "dispense", into(labware_in(protocol, "10")))),
+        ("dilutions", protocol.first(p20_name, "dispense", into(labware_in(protocol, "8")))),
+        ("plating", protocol.first(p20_name, "dispense", into(labware_in(protocol, "3")))),
+    ])
+
+def check_heat_shock():
+    '''Dose matches the target on the modelled ramp, and a stalled ramp fails instead of hanging.'''
+    module = protocol_module("Transformation_protocol.py")
+    protocol = FakeProtocolContext()
+    temp_mod = protocol.load_module("temperature module gen2", "1")
+    trace = module.heat_shock(protocol, module.RunClock(protocol), temp_mod, shock_temp=40, dose_seconds=30)
+    assert abs(trace["measured_seconds"] - 30) <= 1, trace["measured_seconds"]
+    # coarse polls on the ramps keep the run log short
+    delays = sum(1 for t, m, args, kwargs in protocol.commands if m == "delay")
+    assert delays < 40, f"{delays} delay commands for one heat shock"
+    try:
+        module.heat_shock(protocol, module.RunClock(protocol), temp_mod, shock_temp=40, dose_seconds=30,
+                          max_ramp_seconds=60)
+    except RuntimeError:
+        return
+    raise AssertionError("heat shock did not time out")
+
+def check_liquid_height():
+    '''
+    Heights in a 1.5 mL tube's conical tip against the cone volume, a full well at or
+    below its depth, and errors for overfilled wells and labware without a known bottom.
+    '''
+    for file_name in ("Transformation_protocol.py", "Transformation_efficacy_test.py", "Sangin_PCR_enclosed.py"):
+        module = protocol_module(file_name)
+        protocol = FakeProtocolContext()
+        tube = protocol.load_labware("opentrons_24_tuberack_eppendorf_1.5ml_safelock_snapcap", "2")
+        # 50 µL stays in the 17.8 mm cone: V = A h³ / (3 H²)
+        area = math.pi * (tube.wells()[0].diameter / 2) ** 2
+        expected = (3 * 50 * 17.8 ** 2 / area) ** (1 / 3)
+        assert abs(module.liquid_height(tube, 50) - expected) < 0.01, module.liquid_height(tube, 50)
+        for load_name in module.WELL_BOTTOMS:
+            plate = protocol.load_labware(load_name, "1")
+            well = plate.wells()[0]
+            heights = [module.liquid_height(plate, volume) for volume in (1, 10, well.max_volume)]
+            assert heights == sorted(heights), f"{load_name}: heights {heights} do not rise with volume"
+            assert heights[-1] <= well.depth, f"{load_name}: full well at {heights[-1]:.2f} mm"
+        # straight walls over the 3 mm cone, so the tapered well's level is a lower bound
+        pcr = protocol.load_labware("nest_96_wellplate_100ul_pcr_full_skirt", "4")
+        assert abs(module.liquid_height(pcr, 9) - 2.2) < 0.05, module.liquid_height(pcr, 9)
+        reservoir = protocol.load_labware("opentrons_tough_4_reservoir_72ml", "5")
+        for labware, volume in ((pcr, 101), (reservoir, 1000)):
+            try:
+                module.liquid_height(labware, volume)
+            except RuntimeError:
+                continue
+            raise AssertionError(f"{file_name}: {volume} µL in {labware.load_name} gave a height")
+
+def load_cells(loads):
+    '''Operator for sweep pauses: fills the named column spans with cells, noting when.'''
+    def on_pause(protocol, msg):
+        wells = [f"{row}{col}" for first, col, last in re.findall(r"([A-H])(\d+):([A-H])\d+", msg)
+                 for row in "ABCDEFGH" if first <= row <= last]
+        for well in wells:
+            labware_in(protocol, "1")[well].volume = labware_in(protocol, "1")[well].lowest = COMPETENT_CELLS
+        loads.append((len(protocol.commands) - 1, wells))
+    return on_pause
+
+def check_efficacy(sweep, **grid):
+    module = protocol_module("Transformation_efficacy_test.py")
+    batches = module.plan_sweep(*(module.parse_grid(grid.get(name, default), name) for name, default in (
+        ("sweep_ice_minutes", "15,30"), ("sweep_shock_temps", "40,42"), ("sweep_shock_seconds", "30,45"))))
+    samples = 8 * sum(len(batch) for batch in batches) if sweep else 12
+    loaded = transformation_loaded(samples)
+    loads = []
+    if sweep:
+        # cells go onto the block batch by batch, at the run's pauses
+        del loaded["1"]
+    protocol = run_protocol(module, loaded=loaded, on_pause=load_cells(loads), sweep=sweep, **grid)
+    # without a sweep only the ice and heat shock run, so nothing moves
+    check_volumes(protocol, transformation_volumes(samples) if sweep else loaded)
+    temp = "temperature module gen2"
+    shocks = [n for n, (t, m, args, kwargs) in enumerate(protocol.commands)
+              if t == temp and m == "start_set_temperature" and kwargs["celsius"] > 4]
+    if not sweep:
+        assert len(shocks) == 1
+        check_order(protocol, [
+            ("ice", protocol.first(temp, "start_set_temperature")),
+            ("ice delay", protocol.first("protocol", "delay", lambda args, kwargs: kwargs.get("minutes") == 30)),
+            ("heat shock", shocks[0]),
+        ])
+        return
+
+    conditions = [c for c in protocol.comments() if c.startswith("condition=")]
+    assert len(shocks) == len(batches) and len(conditions) == samples // 8, \
+        f"{len(shocks)} shocks, {len(conditions)} conditions"
+    served = [c for c in protocol.comments() if c.startswith("p20 tips")]
+    assert len(served) == samples // 4, f"{len(served)} p20 tip columns reported"
+    # no well holds cells through a heat shock other than its own batch's
+    assert len(loads) == len(batches), f"cells loaded at {len(loads)} pauses for {len(batches)} batches"
+    fields = [dict(field.split("=") for field in condition.split(", ")) for condition in conditions]
+    for n, ((loaded_at, wells), batch) in enumerate(zip(loads, batches)):
+        assert (shocks[n - 1] if n else -1) < loaded_at < shocks[n], f"batch {n + 1} cells loaded out of turn"
+        spans = [f["transform_wells"] for f in fields if int(f["condition"]) in
+                 [condition["condition"] for condition in batch]]
+        assert wells == [f"{row}{span.split(':')[0][1:]}" for span in spans for row in "ABCDEFGH"], \
+            f"batch {n + 1} loaded {wells}, expected {spans}"
+    # every condition shakes at 37 °C for the same time, preheated before the first recovery
+    for condition in fields:
+        recovered_for = int(condition["recovery_end_seconds"]) - int(condition["recovery_start_seconds"])
+        assert recovered_for == 3600, f"{condition}: {recovered_for} s recovery"
+    recover = labware_in(protocol, "10")
+    check_order(protocol, [
+        ("preheat", protocol.first("heaterShakerModuleV1", "set_target_temperature")),
+        ("first recovery", protocol.first("p20_multi_gen2", "dispense", into(recover))),
+        ("shake", protocol.first("heaterShakerModuleV1", "set_and_wait_for_shake_speed")),
+        ("first plating", protocol.first("p20_multi_gen2", "dispense", into(labware_in(protocol, "3")))),
+    ])
+    # each batch's assemblies go in after the previous shock and before its own
+    transform = labware_in(protocol, "1")
+    added = [n for n, (t, m, args, kwargs) in enumerate(protocol.commands)
+             if t == "p20_multi_gen2" and m == "dispense" and into(transform)(args, kwargs)]
+    bounds = [0] + shocks
+    for start, end, batch in zip(bounds, bounds[1:], batches):
+        between = [n for n in added if start < n < end]
+        assert len(between) == len(batch), f"{len(between)} assemblies added between commands {start} and {end}"
+
+#---------
+# PCR
+#---------
+
+# The example reactions that used to be pasted into Sangin_PCR_enclosed, with its primer CSV.
+EXAMPLE_REACTIONS = """gene
+ARO8
+NIT1
+AMD
+
+sample,gene1,gene2,gene3
+Sample1,ARO8,NIT1,AMD
+Sample2,NIT1
+Sample3,ARO8
+Control,,
+"""
+
+def reactions_csv(samples):
+    '''Sample/genes CSV with one to three genes per sample and a trailing control.'''
+    genes = ["ARO8", "NIT1", "AMD"]
+    rows = ["sample,gene1,gene2,gene3"]
+    rows += [",".join([f"Sample{n + 1}"] + genes[:n % 3 + 1]) for n in range(samples)]
+    return "\n".join(rows + ["Control,,"]) + "\n"
+
+def check_plan():
+    module = protocol_module("Sangin_PCR_enclosed.py")
+    plan = module.load_plan(EXAMPLE_REACTIONS)
+    assert module.load_plan(EXAMPLE_REACTIONS) is plan, "plan was parsed twice"
+    assert plan["primers"] == {"ARO8": "A1", "NIT1": "A2", "AMD": "A3"}
+    assert plan["skipped"] == ["Control"]
+
+    # a fresh process reads the plan back from disk, but not one cached by another parser version
+    key = f"v{module.PLAN_PARSER_VERSION}-{hashlib.sha256(EXAMPLE_REACTIONS.encode()).hexdigest()}"
+    assert os.path.exists(os.path.join(module.PLAN_CACHE_DIR, f"{key}.json")), "plan not cached on disk"
+    module = protocol_module("Sangin_PCR_enclosed.py")
+    assert module.load_plan(EXAMPLE_REACTIONS) == plan
+    stale = os.path.join(module.PLAN_CACHE_DIR, f"v{module.PLAN_PARSER_VERSION - 1}-{key.split('-')[1]}.json")
+    with open(stale, "w") as f:
+        json.dump({"primers": {}, "samples": {}, "skipped": []}, f)
+    module.PLAN_PARSER_VERSION -= 1
+    module._PLAN_CACHE.clear()
+    assert module.load_plan(EXAMPLE_REACTIONS)["primers"] == {}, "stale entry not under its own version"
+    module = protocol_module("Sangin_PCR_enclosed.py")
+    assert module.load_plan(EXAMPLE_REACTIONS) == plan, "stale plan served to the current parser"
+    os.remove(stale)
+    # a parser change must come with a version bump
+    source = "".join(inspect.getsource(f) for f in (module.parse_primer_rows, module.parse_sample_rows,
+                                                   module.parse_plan))
+    digest = hashlib.sha256(source.encode()).hexdigest()[:12]
+    assert (module.PLAN_PARSER_VERSION, digest) == (2, "0e23ee508ef0"), \
+        f"parsers changed ({digest}): bump PLAN_PARSER_VERSION and record the new digest here"
+
+    # trailing blank rows do not split the file
+    plan = module.parse_plan("sample,g1,g2\nS1,ARO8,NIT1\nS2,AMD\n\n")
+    assert plan["samples"] == {"S1": ["ARO8", "NIT1"], "S2": ["AMD"]}, plan["samples"]
+    assert plan["primers"] == {"ARO8": "A1", "NIT1": "A2", "AMD": "A3"}, plan["primers"]
+    # the first blank row ends the primer CSV, whatever its header; later ones are ignored
+    plan = module.parse_plan("gene\nNIT1\nARO8\n\n\nsample,g1\nS1,ARO8\n\nS2,NIT1\n\n")
+    assert plan["primers"] == {"NIT1": "A1", "ARO8": "A2"}, plan["primers"]
+    assert plan["samples"] == {"S1": ["ARO8"], "S2": ["NIT1"]}, plan["samples"]
+    for header in ("gene,sequence", "Primer"):
+        contents = f"{header}\nARO8,ATGCAT\n\nsample,gene1,gene2\nS1,ARO8,NIT1"
+        plan = module.parse_plan(contents)
+        assert plan["primers"] == {"ARO8": "A1"}, (header, plan["primers"])
+        assert plan["samples"] == {"S1": ["ARO8", "NIT1"]}, (header, plan["samples"])
+        # NIT1 has no primer row, so the run stops before pipetting
+        try:
+            run_protocol(module, loaded=pcr_loaded(plan), reactions=contents)
+        except RuntimeError as error:
+            assert "NIT1" in str(error), error
+        else:
+            raise AssertionError(f"{header}: NIT1 ran without a primer")
+
+    # same rules as the CSV converter
+    contents = reactions_csv(20)
+    rows = list(csv.reader(contents.splitlines()))
+    sample_genes, skipped = PCR_OT2_CSV_to_dict.parse_sample_rows(rows)
+    plan = module.parse_plan(contents)
+    assert plan["samples"] == sample_genes and plan["skipped"] == skipped
+    assert plan["primers"] == PCR_OT2_CSV_to_dict.parse_primer_rows(
+        [["gene"]] + [[gene] for genes in sample_genes.values() for gene in genes])
+
+# Liquid placed by hand before a PCR run, in µL.
+REAGENT = 1500
+PRIMER = 100
+DNA = 20
+
+def pcr_loaded(plan):
+    '''Water and OneTaq in the tube rack, each primer in its strip well, one DNA well per sample.'''
+    return {"2": {"A2": REAGENT, "A3": REAGENT},
+            "5": {well: PRIMER for well in plan["primers"].values()},
+            "4": {well: DNA for well in plate_wells(len(plan["samples"]))}}
+
+def pcr_volumes(protocol, plan):
+    '''
+    Final volumes after one plate: 50 µL per reaction, 2 µL drawn from a primer and
+    a DNA well for each, and the master mix made (per the run's own comment) split
+    over tubes of at most 29 reactions (10 % overage of 46 µL in 1.5 mL), each left
+    with its overage.
+    '''
+    reactions = [(sample, gene) for sample, genes in plan["samples"].items() for gene in genes]
+    report = next(c for c in protocol.comments() if c.startswith("Creating master mix"))
+    water, onetaq = (float(part.split(" µL")[0]) for part in report.split(": ")[1].split(" + "))
+    loaded = pcr_loaded(plan)
+    tubes = [well for well in plate_wells(24, rows=4) if well not in ("A2", "A3")]
+    loads = [min(29, len(reactions) - start) for start in range(0, len(reactions), 29)]
+    expected = {None: {well: 50 for well in plate_wells(len(reactions))},
+                "2": {"A2": REAGENT - water, "A3": REAGENT - onetaq,
+                      **{tube: 46 * 0.1 * n for tube, n in zip(tubes, loads)}},
+                "5": dict(loaded["5"]), "4": dict(loaded["4"])}
+    dna_wells = dict(zip(plan["samples"], plate_wells(len(plan["samples"]))))
+    for sample, gene in reactions:
+        expected["5"][plan["primers"][gene]] -= 2
+        expected["4"][dna_wells[sample]] -= 2
+    return expected
+
+def check_pcr(contents):
+    module = protocol_module("Sangin_PCR_enclosed.py")
+    plan = module.parse_plan(contents)
+    protocol = run_protocol(module, loaded=pcr_loaded(plan), reactions=contents)
+    check_volumes(protocol, pcr_volumes(protocol, plan))
+    pcr_plate = labware_in(protocol, None)
+    reactions = [well for well in pcr_plate.wells() if well.volume]
+
+    p20 = pipette(protocol, "p20_single_gen2")
+    assert p20.pickups == 2 * len(reactions), f"{p20.pickups} p20 pickups for {len(reactions)} reactions"
+
+    tube_rack = labware_in(protocol, "2")
+    check_order(protocol, [
+        ("master mix", protocol.first("p300_single_gen2", "dispense", into(tube_rack))),
+        ("distribute", protocol.first("p300_single_gen2", "dispense", into(pcr_plate))),
+        ("primers", protocol.first(p20.name, "aspirate", into(labware_in(protocol, "5")))),
+        ("DNA", protocol.first(p20.name, "aspirate", into(labware_in(protocol, "4")))),
+        ("PCR", protocol.first("thermocycler", "close_lid")),
+    ])
+
+def check_reagent_capacity():
+    '''A run whose water or OneTaq would not fit in one tube stops before pipetting.'''
+    module = protocol_module("Sangin_PCR_enclosed.py")
+    contents = reactions_csv(60)
+    try:
+        run_protocol(module, loaded=pcr_loaded(module.parse_plan(contents)), reactions=contents)
+    except RuntimeError:
+        return
+    raise AssertionError("117 reactions ran from single reagent tubes")
+
+def check_mixing():
+    '''Mix commands per reaction for each policy; the final mix is the same in all of them.'''
+    module = protocol_module("Sangin_PCR_enclosed.py")
+    contents = reactions_csv(20)
+    plan = module.parse_plan(contents)
+    for policy, mixes in (("each", 2), ("final", 1), ("dispense", 1)):
+        for touch_tip in (True, False):
+            protocol = run_protocol(module, loaded=pcr_loaded(plan), reactions=contents,
+                                    mix_policy=policy, touch_tip=touch_tip)
+            check_volumes(protocol, pcr_volumes(protocol, plan))
+            reactions = len([well for well in labware_in(protocol, None).wells() if well.volume])
+            commands = [(m, args) for t, m, args, kwargs in protocol.commands if t == "p20_single_gen2"]
+            strokes = sum(args[0] for m, args in commands if m == "mix")
+            touches = sum(1 for m, args in commands if m == "touch_tip")
+            assert sum(1 for m, args in commands if m == "mix") == mixes * reactions, policy
+            assert strokes == (8 if policy == "each" else 5 if policy == "final" else 4) * reactions, policy
+            assert touches == (2 * reactions if touch_tip else 0), f"{touches} touch tips"
+            report = next(c for c in protocol.comments() if c.startswith("Mixing overhead"))
+            saved = float(report.split(", ")[-1].split(" s saved")[0])
+            assert (saved == 0) == (policy == "each" and touch_tip), report
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    for samples in (1, 7, 8, 12, 45, 96):
+        check_transformation(samples)
+    check_heat_shock()
+    check_liquid_height()
+    check_efficacy(sweep=False)
+    check_efficacy(sweep=True)
+    check_efficacy(sweep=True, sweep_ice_minutes="20", sweep_shock_temps="42",
+                   sweep_shock_seconds="30, 45, 60")
+    check_plan()
+    check_pcr(EXAMPLE_REACTIONS)
+    for samples in (1, 10, 20):
+        check_pcr(reactions_csv(samples))
+    check_reagent_capacity()
+    check_mixing()
+    print(f"All protocol checks passed in {time.perf_counter() - start:.2f} s.")
@@ -2,6 +2,58 @@ import csv
 import tkinter as tk
 from tkinter import filedialog
 
+def parse_primer_rows(rows):
+    '''
+    Assign each unique gene in the first column to a primer rack well.
+
+    :param rows: CSV rows including the header row.
+    :return: {gene: well name}, wells filled A1..H12 in row order.
+    '''
+    rows = iter(rows)
+    header = next(rows, None)  # Skip header row
+
+    # Extract all unique gene names from the first column
+    genes = []
+    for row in rows:
+        if not row:
+            continue
+        gene = row[0].strip()
+        if gene and gene not in genes:
+            genes.append(gene)
+
+    # Generate well names in A1..H12 order
+    well_names = [f"{r}{c}" for r in "ABCDEFGH" for c in range(1, 13)]
+
+    if len(genes) > len(well_names):
+        raise RuntimeError(
+            f"Too many primers ({len(genes)}) for available wells ({len(well_names)})."
+        )
+
+    return dict(zip(genes, well_names))
+
+def parse_sample_rows(rows):
+    '''
+    Map each sample in the first column to the genes in the remaining columns.
+
+    :param rows: CSV rows including the header row.
+    :return: ({sample: [genes]}, [samples skipped because they list no genes])
+    '''
+    rows = iter(rows)
+    header = next(rows, None)
+
+    sample_genes = {}
+    skipped = []
+    for row in rows:
+        if not row:
+            continue
+        sample = row[0].strip()
+        genes = [g.strip() for g in row[1:] if g.strip()]
+        if genes:  # only add if the list is non-empty
+            sample_genes[sample] = genes
+        else:
+            skipped.append(sample)
+    return sample_genes, skipped
+
 def build_primer_dict():
     # Hide the Tkinter root window
     root = tk.Tk()
@@ -17,32 +69,11 @@ def build_primer_dict():
         print("No file selected.")
         return {}
 
-    primer_map = {}
     with open(file_path, newline='') as f:
-        reader = csv.reader(f)
-        header = next(reader)  # Skip header row
-
-        # Extract all unique gene names from the first column
-        genes = []
-        for row in reader:
-            if not row:
-                continue
-            gene = row[0].strip()
-            if gene and gene not in genes:
-                genes.append(gene)
-
-    # Generate well names in A1..H12 order
-    rows = "ABCDEFGH"
-    cols = range(1, 13)
-    well_names = [f"{r}{c}" for r in rows for c in cols]
+        primer_wells = parse_primer_rows(csv.reader(f))
 
-    if len(genes) > len(well_names):
-        raise RuntimeError(
-            f"Too many primers ({len(genes)}) for available wells ({len(well_names)})."
-        )
-
-    # Assign each gene to a well in order
-    for gene, well in zip(genes, well_names):
+    primer_map = {}
+    for gene, well in primer_wells.items():
         primer_map[gene] = f'primer_rack.wells_by_name()["{well}"]'
 
     return primer_map
@@ -62,20 +93,12 @@ def build_sample_genes():
         print("No file selected.")
         return {}
     
-    sample_genes = {}
     with open(file_path, newline='') as f:
-        reader = csv.reader(f)
-        header = next(reader)
-
-        for row in reader:
-            sample = row[0].strip()
-            genes = [g.strip() for g in row[1:] if g.strip()]
-            if genes:  # only add if the list is non-empty
-                sample_genes[sample] = genes
-            else:
-                # optional: log that this sample was skipped
-                print(f"Skipping control sample {sample} (no genes)")
-    
+        sample_genes, skipped = parse_sample_rows(csv.reader(f))
+
+    for sample in skipped:
+        print(f"Skipping control sample {sample} (no genes)")
+
     return sample_genes
 
 
@@ -1,5 +1,6 @@
 from opentrons import protocol_api
 import math
+import time
 
 '''
 The protocol for transformations to be tested with Sam. 
@@ -22,8 +23,331 @@ requirements = {
     "apiLevel" : "2.27"
 }
 
+#---------
+# Column planning
+#---------
+
+def plan_columns(samples, channels=8):
+    '''
+    Map a sample count onto plate columns.
+
+    :param samples: Number of samples, 1-96.
+    :param channels: Channels on the multichannel pipette.
+    :return: List of (column index, rows used). Full columns come first, then
+             one partial column when samples is not a multiple of channels.
+    '''
+    if not 1 <= samples <= 96:
+        raise ValueError(f"Sample count must be between 1 and 96, got {samples}.")
+    full, partial = divmod(samples, channels)
+    plan = [(col, channels) for col in range(full)]
+    if partial:
+        plan.append((full, partial))
+    return plan
+
+def nozzle_well(labware, well, rows):
+    '''
+    Well to target so the active channels cover ``rows`` wells starting at ``well``.
+
+    Partial layouts on the OT-2 use H1 as the primary nozzle, so the target is the
+    last well of the group rather than the first. Troughs that span every channel
+    are returned unchanged.
+    '''
+    step = len(labware.rows()) // 8
+    if rows == 8 or step == 0:
+        return well
+    row = chr(ord(well.well_name[0]) + step * (rows - 1))
+    return labware.wells_by_name()[row + well.well_name[1:]]
+
+def column_well(labware, column, rows):
+    '''Target well for ``rows`` samples in ``column`` of a plate.'''
+    return nozzle_well(labware, labware.columns()[column][0], rows)
+
+def configure_nozzles(pipette, rows):
+    '''Set the 8-channel layout for a full column, partial column, or single sample.'''
+    if rows == 8:
+        pipette.configure_nozzle_layout(style=protocol_api.ALL)
+    elif rows == 1:
+        pipette.configure_nozzle_layout(style=protocol_api.SINGLE, start="H1")
+    else:
+        pipette.configure_nozzle_layout(
+            style=protocol_api.PARTIAL_COLUMN, start="H1", end=f"{'ABCDEFGH'[8 - rows]}1")
+
+#---------
+# Tip allocation
+#---------
+
+class TipAllocator:
+    '''
+    Reserve p20 tip columns per sample column and step.
+
+    Steps in one chain share a tip column per sample column and must use it in
+    chain order, so a tip is only carried forward along the same sample, e.g.
+    ("dilutions", "plating") plates from the most dilute well back with the tip
+    that made the dilutions. Every pickup is logged as
+    (step, sample column, rack, tip column), and summary() turns the log into run comments.
+    '''
+
+    def __init__(self, tip_racks, chains, sample_col, columns_per_rack=12):
+        needed = self.racks_needed(chains, sample_col, columns_per_rack)
+        if len(tip_racks) < needed:
+            raise RuntimeError(
+                f"{sample_col} sample columns need {needed} tip racks, only {len(tip_racks)} loaded.")
+        self.tip_racks = tip_racks
+        self.chains = chains
+        self.sample_col = sample_col
+        self.columns_per_rack = columns_per_rack
+        self.log = []
+        self._used = {}
+
+    @staticmethod
+    def racks_needed(chains, sample_col, columns_per_rack=12):
+        '''Minimum number of tip racks for the chains over ``sample_col`` columns.'''
+        return math.ceil(len(chains) * sample_col / columns_per_rack)
+
+    def _chain(self, step):
+        for n, chain in enumerate(self.chains):
+            if step in chain:
+                return n
+        raise KeyError(f"Step '{step}' is not in any tip chain.")
+
+    def reserve(self, step, column):
+        '''(rack index, tip column) reserved for ``step`` on sample ``column``.'''
+        index = self._chain(step) * self.sample_col + column
+        return divmod(index, self.columns_per_rack)
+
+    def tip(self, step, column, rows):
+        '''
+        Tip well to pick up for ``step`` on sample ``column``.
+
+        :param rows: Channels in use, so partial columns line up with the H1 nozzle.
+        '''
+        chain = self._chain(step)
+        position = self.chains[chain].index(step)
+        done = self._used.get((chain, column), 0)
+        if position < done:
+            raise RuntimeError(
+                f"'{step}' cannot reuse the tip already used by "
+                f"'{self.chains[chain][done - 1]}' on sample column {column}.")
+        self._used[(chain, column)] = position + 1
+        rack, tip_col = self.reserve(step, column)
+        self.log.append((step, column, rack, tip_col))
+        return column_well(self.tip_racks[rack], tip_col, rows)
+
+    def summary(self):
+        '''One line per tip column used: its rack, the sample column it served and the steps, in order.'''
+        served = {}
+        for step, column, rack, tip_col in self.log:
+            served.setdefault((rack, tip_col, column), []).append(step)
+        return [f"p20 tips {self.tip_racks[rack]} column {tip_col + 1}: sample column {column + 1}, "
+                f"{' -> '.join(steps)}" for (rack, tip_col, column), steps in sorted(served.items())]
+
+#---------
+# Heat shock
+#---------
+
+# Approximate Temperature Module GEN2 block ramp rates (°C/s), used to model the
+# block while simulating. TEMP_MOD_COOL_RATE is also the calibration for the real
+# hold: the hold is shortened by the time to cool from setpoint to the threshold.
+# Recalibrate it from the cool_tail_seconds of a measured trace on the robot.
+TEMP_MOD_HEAT_RATE = 0.1
+TEMP_MOD_COOL_RATE = 0.1
+
+# Longest wait (s) for the block to cross the threshold before failing the run.
+TEMP_MOD_MAX_RAMP = 900
+
+class RunClock:
+    '''Seconds since the clock was created, advanced by its own waits when simulating.'''
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self._start = time.monotonic()
+        self._simulated = 0.0
+
+    def now(self):
+        if self.protocol.is_simulating():
+            return self._simulated
+        return time.monotonic() - self._start
+
+    def wait(self, seconds):
+        if seconds > 0:
+            self.protocol.delay(seconds=seconds)
+            self._simulated += seconds
+
+    def wait_until(self, t):
+        self.wait(t - self.now())
+
+def heat_shock(protocol, clock, temp_mod, shock_temp, dose_seconds,
+               threshold=None, recover_temp=4, poll_seconds=1, ramp_poll_seconds=30,
+               cool_rate=TEMP_MOD_COOL_RATE, max_ramp_seconds=TEMP_MOD_MAX_RAMP):
+    '''
+    Heat shock dosed by time spent above a threshold instead of time at setpoint.
+
+    The ramp up is polled until the block crosses the threshold. The hold is then
+    shortened by the expected cool-down tail, and the ramp down is polled until the
+    block falls back below the threshold. Ramps are polled at a third of the modelled
+    time left to the threshold, so polls are sparse far from it and every
+    ``poll_seconds`` close to it.
+
+    :param shock_temp: Heat shock setpoint (°C).
+    :param dose_seconds: Target seconds above the threshold.
+    :param threshold: Temperature counted as heat shock, defaults to 1 °C below setpoint.
+    :param recover_temp: Temperature to ramp back down to (°C).
+    :param poll_seconds: Finest poll interval, near the threshold.
+    :param ramp_poll_seconds: Coarsest poll interval, far from the threshold and during the hold.
+    :param cool_rate: Calibrated cooling rate (°C/s) used to size the cool-down tail.
+    :param max_ramp_seconds: Fail if either ramp takes longer than this to cross the threshold.
+    :return: Timing trace with the target, hold, measured and cool-down tail seconds
+             and (seconds, °C) samples from the start of the ramp.
+    '''
+    if threshold is None:
+        threshold = shock_temp - 1
+    simulating = protocol.is_simulating()
+    block = {"temp": recover_temp, "target": shock_temp}
+    start = clock.now()
+
+    def read():
+        return block["temp"] if simulating else temp_mod.temperature
+
+    def poll(seconds=poll_seconds):
+        clock.wait(seconds)
+        if simulating:
+            rate = TEMP_MOD_HEAT_RATE if block["target"] > block["temp"] else TEMP_MOD_COOL_RATE
+            step = min(rate * seconds, abs(block["target"] - block["temp"]))
+            block["temp"] += step if block["target"] > block["temp"] else -step
+        trace["samples"].append((round(clock.now() - start, 1), round(read(), 1)))
+
+    def wait_for(crossed, direction, rate):
+        deadline = clock.now() + max_ramp_seconds
+        while not crossed():
+            if clock.now() > deadline:
+                raise RuntimeError(
+                    f"Temperature module did not {direction} {threshold} °C within {max_ramp_seconds} s.")
+            modelled = abs(read() - threshold) / rate
+            poll(min(ramp_poll_seconds, max(poll_seconds, modelled / 3)))
+
+    tail = (shock_temp - threshold) / cool_rate
+    trace = {
+        "shock_temp": shock_temp,
+        "threshold": threshold,
+        "target_seconds": dose_seconds,
+        "hold_seconds": max(0, dose_seconds - tail),
+        "samples": [(0.0, round(read(), 1))],
+    }
+
+    temp_mod.start_set_temperature(celsius=shock_temp)
+    wait_for(lambda: read() >= threshold, "rise above", TEMP_MOD_HEAT_RATE)
+    above = clock.now()
+    while clock.now() < above + trace["hold_seconds"]:
+        poll(min(ramp_poll_seconds, above + trace["hold_seconds"] - clock.now()))
+
+    block["target"] = recover_temp
+    temp_mod.start_set_temperature(celsius=recover_temp)
+    cooling = clock.now()
+    wait_for(lambda: read() < threshold, "fall below", cool_rate)
+    trace["measured_seconds"] = round(clock.now() - above, 1)
+    trace["cool_tail_seconds"] = round(clock.now() - cooling, 1)
+
+    protocol.comment(
+        f"Heat shock: {trace['measured_seconds']} s above {threshold} °C "
+        f"(target {dose_seconds} s, hold {trace['hold_seconds']:.0f} s, "
+        f"cool-down tail {trace['cool_tail_seconds']} s).")
+    return trace
+
+#---------
+# Labware geometry
+#---------
+
+# Bottom section per load name as (shape, height mm), following wellBottomShape in
+# the Opentrons definitions. "u" bottoms are hemispheres as wide as the well, so their
+# height is derived. liquid_height raises for labware not listed here.
+WELL_BOTTOMS = {
+    "nest_96_wellplate_100ul_pcr_full_skirt": ("v", 3.0),
+    "opentrons_96_wellplate_200ul_pcr_full_skirt": ("v", 3.0),
+    "opentrons_96_aluminumblock_generic_pcr_strip_200ul": ("v", 3.0),
+    "appliedbiosystemsmicroamp_384_wellplate_40ul": ("v", 2.0),
+    "axygen_96_wellplate_500ul": ("v", 2.0),
+    "opentrons_24_tuberack_eppendorf_1.5ml_safelock_snapcap": ("v", 17.8),
+    "nest_96_wellplate_200ul_flat": ("flat", 0),
+}
+
+# (top area mm², depth mm, bottom shape, bottom height mm, max volume µL) per labware
+# load name
+_WELL_GEOMETRY = {}
+
+def _solve(f, target, low, high):
+    '''Where the increasing function ``f`` reaches ``target`` in [low, high], by bisection.'''
+    for _ in range(50):
+        mid = (low + high) / 2
+        if f(mid) < target:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+def _well_volume(geometry, height):
+    '''Volume (µL) below ``height`` mm: the bottom section, then straight walls to the top.'''
+    top, depth, shape, bottom, max_volume = geometry
+    below = min(height, bottom)
+    if shape == "v":
+        volume = top * below ** 3 / (3 * bottom ** 2) if bottom else 0
+    elif shape == "u":
+        volume = math.pi * (bottom * below ** 2 - below ** 3 / 3)
+    else:
+        volume = 0
+    return volume + top * max(0, height - bottom)
+
+def well_geometry(labware):
+    '''
+    Well shape for a labware, read from its definition once and cached.
+
+    The bottom section comes from WELL_BOTTOMS; above it the walls are taken as
+    straight at the width of the top opening. Definitions give no wall taper, so for
+    tapered wells (PCR plates, 384-well plates) this overstates the volume per mm and
+    heights come out low: a lower bound, e.g. 9 µL in nest_96_wellplate_100ul_pcr_full_skirt
+    gives 2.2 mm. Aspirating there keeps the tip submerged.
+    '''
+    if labware.load_name not in _WELL_GEOMETRY:
+        if labware.load_name not in WELL_BOTTOMS:
+            raise RuntimeError(f"No well bottom for {labware.load_name}; add it to WELL_BOTTOMS.")
+        well = labware.wells()[0]
+        if well.diameter:
+            top = math.pi * (well.diameter / 2) ** 2
+        else:
+            top = well.length * well.width
+        shape, bottom = WELL_BOTTOMS[labware.load_name]
+        if shape == "u":
+            bottom = math.sqrt(top / math.pi)
+        _WELL_GEOMETRY[labware.load_name] = (top, well.depth, shape, min(bottom, well.depth), well.max_volume)
+    return _WELL_GEOMETRY[labware.load_name]
+
+def liquid_height(labware, volume):
+    '''Height (mm) of ``volume`` µL above the well bottom; raises past the well's max volume.'''
+    geometry = well_geometry(labware)
+    if volume > geometry[4]:
+        raise RuntimeError(f"{volume} µL is more than a {labware.load_name} well holds ({geometry[4]} µL).")
+    return _solve(lambda height: _well_volume(geometry, height), volume, 0, geometry[1])
+
+def add_parameters(parameters):
+
+    parameters.add_int(
+        variable_name="samples",
+        display_name="Samples",
+        description="Number of transformations, 1-96.",
+        default=12,
+        minimum=1,
+        maximum=96)
+
 def run(protocol: protocol_api.ProtocolContext):
 
+    #---------
+    # Samples
+    #---------
+
+    samples = protocol.params.samples
+    # (column, rows) per sample column; shared by every step below
+    column_plan = plan_columns(samples)
+    sample_col = len(column_plan)
+
     #---------
     # Labware
     # --------    
@@ -39,11 +363,17 @@ def run(protocol: protocol_api.ProtocolContext):
 
     #Resevoir and Assemblies
     resevoir = protocol.load_labware('opentrons_tough_4_reservoir_72ml', '2')
-    assemblies = protocol.load_labware('opentrons_tough_4_reservoir_72ml', '5')
+    assemblies = protocol.load_labware('nest_96_wellplate_100ul_pcr_full_skirt', '5')
 
     #Pipette and tips
-    p20_tiprack = protocol.load_labware('opentrons_96_tiprack_20ul', '4')
-    p20_multi = protocol.load_instrument('p20_multi_gen2', 'left', tip_racks=[p20_tiprack])
+    # Transformation and recovery carry the same sample forward, as do dilutions and plating.
+    p20_tip_chains = (("transformation", "recovery"), ("dilutions", "plating"))
+    p20_racks_needed = TipAllocator.racks_needed(p20_tip_chains, sample_col)
+    p20_tipracks = [protocol.load_labware('opentrons_96_tiprack_20ul', slot)
+                    for slot in ('4', '11')[:p20_racks_needed]]
+    p20_multi = protocol.load_instrument('p20_multi_gen2', 'left', tip_racks=p20_tipracks)
+    p20_tips = TipAllocator(p20_tipracks, p20_tip_chains, sample_col)
+    protocol.comment(f"{samples} samples in {sample_col} columns: {p20_racks_needed} p20 tip rack(s).")
 
     p300_tiprack = protocol.load_labware('opentrons_96_tiprack_300ul', '7')
     p300_multi = protocol.load_instrument('p300_multi_gen2', 'right', tip_racks=[p300_tiprack] )
@@ -66,19 +396,15 @@ def run(protocol: protocol_api.ProtocolContext):
     p300_multi.flow_rate.aspirate = 40
     p300_multi.flow_rate.dispense = 70
 
-    samples = 12
-    sample_col = samples // 8
-    assembly_wells = assemblies.wells()[0:sample_col:8]
-    recovery_wells = recover.wells()[0:sample_col:8]
-    trans_wells = transform.wells()[0:sample_col:8]
+    clock = RunClock(protocol)
 
     plates = (agar_plate_1, agar_plate_2, agar_plate_3)
 
     dilution_wells = {}
-    for i in range(sample_col):  # sample_col = number of 8-channel samples
-        col_start = 2 * i
+    for col, rows in column_plan:
+        col_start = 2 * col
 
-        dilution_wells[i] = (
+        dilution_wells[col] = (
             dil_plate.rows()[0][col_start],     # A?
             dil_plate.rows()[0][col_start + 1], # A?
             dil_plate.rows()[1][col_start],     # B?
@@ -86,31 +412,36 @@ def run(protocol: protocol_api.ProtocolContext):
         )
     
     agar_vol = 30
-    agar_height = (agar_vol * 0.001) / (math.pi * math.sqrt(3.43))
+    # Media per dilution well: with the 3 µL transfers a well peaks at 39 µL, inside the
+    # 40 µL 384-well plate, and each step dilutes 1:13.
+    dilution_media_vol = 36
 
     def create_plates(plate_vol):
         '''Create 96-well plates using tempered agar from resevoir.'''
         p300_multi.pick_up_tip()
 
-        for i in range(sample_col):
+        # Dispense at the final agar surface so the tip stays out of setting agar.
+        for col, rows in column_plan:
             for plate in plates:
-                dest = plate.columns()[i][0]
+                dest = plate.columns()[col][0]
                 p300_multi.aspirate(location=resevoir.wells()[1], volume = plate_vol)
-                p300_multi.dispense(location = dest)
+                p300_multi.dispense(location = dest.bottom(liquid_height(plate, plate_vol)))
                 p300_multi.blow_out(dest.top())
         p300_multi.return_tip()
         
     def distribute_media(dilution_vol, recovery_vol):
         """Distribute media to dilution and recovery wells."""
         p300_multi.pick_up_tip()
-        for i in range(sample_col):
-            for well in dilution_wells[i]:
+        # Bulk fills use the whole column; media in unused rows is harmless.
+        for col, rows in column_plan:
+            for well in dilution_wells[col]:
                 p300_multi.aspirate(location=resevoir.wells()[0], volume = dilution_vol)
-                p300_multi.dispense(location = well)
+                p300_multi.dispense(location = well.bottom(liquid_height(dil_plate, dilution_vol)))
                 p300_multi.blow_out(well.top())
-        for well in recovery_wells:
+        for col, rows in column_plan:
+            well = recover.columns()[col][0]
             p300_multi.aspirate(location=resevoir.wells()[0], volume = recovery_vol)
-            p300_multi.dispense(location = well)
+            p300_multi.dispense(location = well.bottom(liquid_height(recover, recovery_vol)))
             p300_multi.blow_out(well.top())
         p300_multi.return_tip()
 
@@ -120,12 +451,14 @@ def run(protocol: protocol_api.ProtocolContext):
         
         :param assembly_vol: Volume to be transformed per well.
         '''
-        for well in assembly_wells:
-            dest = transform.well(well.well_name)
-            p20_multi.pick_up_tip()
+        for col, rows in column_plan:
+            well = column_well(assemblies, col, rows)
+            dest = column_well(transform, col, rows)
+            configure_nozzles(p20_multi, rows)
+            p20_multi.pick_up_tip(location = p20_tips.tip("transformation", col, rows))
             p20_multi.aspirate(location= well, volume = assembly_vol)
             p20_multi.dispense(location = dest)
-            p20_multi.blow_out(well.top())
+            p20_multi.blow_out(dest.top())
             p20_multi.return_tip()
 
     def recovery(recover_vol):
@@ -134,36 +467,40 @@ def run(protocol: protocol_api.ProtocolContext):
         
         :param trans_vol: Volume to be recovered per well.
         '''
-        for well in trans_wells:
-            dest = recover.well(well.well_name)
-            p20_multi.pick_up_tip()
+        for col, rows in column_plan:
+            well = column_well(transform, col, rows)
+            dest = column_well(recover, col, rows)
+            configure_nozzles(p20_multi, rows)
+            p20_multi.pick_up_tip(location = p20_tips.tip("recovery", col, rows))
             p20_multi.aspirate(location= well, volume = recover_vol)
             p20_multi.dispense(location = dest)
-            p20_multi.blow_out(well.top())
+            p20_multi.blow_out(dest.top())
             p20_multi.return_tip()
 
     def dilutions(dil1,dil2,dil3,dil4):
         '''Dilution of transformed samples.'''
 
-        for i in range(sample_col):
-            sample = recover.columns()[i][0]
+        for col, rows in column_plan:
+            sample = column_well(recover, col, rows)
+            dil = [nozzle_well(dil_plate, well, rows) for well in dilution_wells[col]]
             '''
             Dilution order:
             [1|3]
             [2|4]
             '''
-            p20_multi.pick_up_tip(location = p20_tiprack()[i])
+            configure_nozzles(p20_multi, rows)
+            p20_multi.pick_up_tip(location = p20_tips.tip("dilutions", col, rows))
             p20_multi.aspirate(location = sample, volume = dil1)
-            p20_multi.dispense(location = dilution_wells[i][0])
+            p20_multi.dispense(location = dil[0])
             p20_multi.mix(repetitions = 5, volume=3)
-            p20_multi.aspirate(location = dilution_wells[i][0], volume = dil2)
-            p20_multi.dispense(location = dilution_wells[i][1])
+            p20_multi.aspirate(location = dil[0], volume = dil2)
+            p20_multi.dispense(location = dil[1])
             p20_multi.mix(repetitions = 5, volume=3)
-            p20_multi.aspirate(location = dilution_wells[i][1], volume = dil3)
-            p20_multi.dispense(location = dilution_wells[i][2])
+            p20_multi.aspirate(location = dil[1], volume = dil3)
+            p20_multi.dispense(location = dil[2])
             p20_multi.mix(repetitions = 5, volume=3)
-            p20_multi.aspirate(location = dilution_wells[i][2], volume = dil4)
-            p20_multi.dispense(location = dilution_wells[i][3])
+            p20_multi.aspirate(location = dil[2], volume = dil4)
+            p20_multi.dispense(location = dil[3])
             p20_multi.mix(repetitions = 5, volume=3)
             p20_multi.return_tip()
 
@@ -171,16 +508,19 @@ def run(protocol: protocol_api.ProtocolContext):
         '''
         Plating of dilutions on 96-well agar plates.
         '''
-        p20_multi.well_bottom_clearance.dispense = agar_height + 0.3
-
-        for i in range(sample_col):
-                p20_multi.pick_up_tip(location = p20_tiprack()[i])
-                p20_multi.aspirate(location = dilution_wells[i][3], volume = 3)
-                p20_multi.dispense(location = agar_plate_1.wells()[i])
-                p20_multi.aspirate(location = dilution_wells[i][2], volume = 3)
-                p20_multi.dispense(location = agar_plate_2.wells()[i])
-                p20_multi.aspirate(location = dilution_wells[i][1], volume = 3)
-                p20_multi.dispense(location = agar_plate_3.wells()[i])
+        for col, rows in column_plan:
+                configure_nozzles(p20_multi, rows)
+                p20_multi.pick_up_tip(location = p20_tips.tip("plating", col, rows))
+                dil = [nozzle_well(dil_plate, well, rows) for well in dilution_wells[col]]
+                p20_multi.aspirate(location = dil[3], volume = 3)
+                p20_multi.dispense(location = column_well(agar_plate_1, col, rows).bottom(
+                    liquid_height(agar_plate_1, agar_vol) + 0.3))
+                p20_multi.aspirate(location = dil[2], volume = 3)
+                p20_multi.dispense(location = column_well(agar_plate_2, col, rows).bottom(
+                    liquid_height(agar_plate_2, agar_vol) + 0.3))
+                p20_multi.aspirate(location = dil[1], volume = 3)
+                p20_multi.dispense(location = column_well(agar_plate_3, col, rows).bottom(
+                    liquid_height(agar_plate_3, agar_vol) + 0.3))
                 p20_multi.return_tip()
 
     def main():
@@ -189,18 +529,18 @@ def run(protocol: protocol_api.ProtocolContext):
         temp_mod.start_set_temperature(celsius=4)
 
         #create agar plates
-        create_plates(30)
+        create_plates(agar_vol)
 
         #preheat heater/shaker
         hs_mod.set_target_temperature(celsius=37)
 
         #Distribute media into recovery and dilution wells
-        distribute_media(60, 90)
+        distribute_media(dilution_media_vol, 90)
 
         # transformation profile
         transformation(9)
-        temp_mod.set_temperature(celsius=40)
-        protocol.delay(seconds = 30)
+        trace = heat_shock(protocol, clock, temp_mod, shock_temp=40, dose_seconds=30)
+        protocol.comment("Heat shock trace (s, °C): " + ", ".join(f"{t}:{c}" for t, c in trace["samples"]))
         temp_mod.set_temperature(celsius=4)
         protocol.delay(minutes = 10)
         temp_mod.deactivate()
@@ -219,6 +559,10 @@ def run(protocol: protocol_api.ProtocolContext):
 
         #plate dilutions
         plating()
+
+        #which p20 tip served which sample column and steps
+        for line in p20_tips.summary():
+            protocol.comment(line)
         
 
     #run protocol